@@ -1,11 +1,26 @@
+from functools import partial
 from logging.handlers import QueueListener
-from multiprocessing import Queue
+from multiprocessing import Event, Queue
 import argparse
 import logging
+import os
+import socket
+import sys
+
+from redis.exceptions import ResponseError
 
 from redis_data_transfer.display import Display
-from redis_data_transfer.processing import Drain, Processor, Source, TombStone
-from redis_data_transfer.redis_client import _redis_client
+from redis_data_transfer.distributed import (
+    LEASE_TIMEOUT_SEC,
+    Reporter,
+    claim_partitions,
+    complete_partition,
+    partition_count,
+    run_coordinator,
+)
+from redis_data_transfer.encoding import CODECS, PackedBatch
+from redis_data_transfer.processing import Drain, Processor, Source, TombStone, put_unless_aborted
+from redis_data_transfer.redis_client import _redis_client, _scan_node, _scan_slots
 from redis_data_transfer.state import StatsTracker
 
 
@@ -13,7 +28,8 @@ def main():
     parser = argparse.ArgumentParser("Move data from redis(-cluster) to redis(-cluster)")
 
     parser.add_argument('source', help="Source server as hostname[:port][#database]")
-    parser.add_argument('destination', help="Destination server as  as hostname[:port][#database]")
+    parser.add_argument('destination', nargs='?',
+                        help="Destination server as  as hostname[:port][#database], not used with --coordinate")
     parser.add_argument('--count', help="Number of key/values to copy", default=None, type=int)
     parser.add_argument('--batch', help="Number of key/values per batch", default=10000, type=int)
     parser.add_argument('--checkers', help='Number of checker processes', default=0, type=int)
@@ -24,20 +40,72 @@ def main():
     parser.add_argument('--no-track-items',
                         dest='track_items', action='store_false')
     parser.set_defaults(track_items=False)
+    parser.add_argument('--compress', help='Pack values between readers and writers, compressed with this codec',
+                        dest='compress', choices=sorted(CODECS))
+    parser.add_argument('--no-compress',
+                        dest='compress', action='store_const', const=None)
+    parser.set_defaults(compress=None)
     parser.add_argument('--refresh-interval', help='Status refresh interval in seconds',
                         default=1.0, type=float)
+    parser.add_argument('--coordinate', metavar='HOST:PORT',
+                        help='Run as coordinator, handing out keyspace partitions on HOST:PORT')
+    parser.add_argument('--coordinator', metavar='HOST:PORT',
+                        help='Run as worker, claiming partitions from the coordinator at HOST:PORT')
+    parser.add_argument('--partitions', help='Number of slot range partitions for a cluster source',
+                        default=64, type=partition_count)
+    parser.add_argument('--lease-timeout', help='Seconds without report before a partition is reassigned',
+                        dest='lease_timeout', default=LEASE_TIMEOUT_SEC, type=float)
+    parser.add_argument('--worker-name', help='Name reported to the coordinator',
+                        dest='worker_name', default=f'{socket.gethostname()}_{os.getpid()}')
     args = parser.parse_args()
+    _check_mode_options(parser, args)
 
     log_queue = _configure_logging()
 
-    move_data(
-        args.source, args.destination,
-        args.count, args.batch,
-        args.checkers, args.readers, args.writers,
-        log_queue,
-        args.track_items,
-        args.refresh_interval,
-    )
+    if args.coordinate:
+        if not run_coordinator(args.source, args.coordinate, args.partitions, args.batch, args.lease_timeout):
+            sys.exit(1)
+    elif args.coordinator:
+        transfer_partitions(
+            args.coordinator, args.worker_name,
+            args.source, args.destination,
+            args.batch,
+            args.checkers, args.readers, args.writers,
+            log_queue,
+            args.track_items,
+            args.refresh_interval,
+            args.compress,
+        )
+    elif not move_data(
+            args.source, args.destination,
+            args.count, args.batch,
+            args.checkers, args.readers, args.writers,
+            log_queue,
+            args.track_items,
+            args.refresh_interval,
+            compress=args.compress,
+    ):
+        sys.exit(1)
+
+
+def _check_mode_options(parser, args):
+    if args.coordinate and args.coordinator:
+        parser.error('--coordinate and --coordinator cannot be combined')
+
+    if args.coordinate:
+        if args.destination is not None:
+            parser.error('the coordinator does not take a destination')
+        unused = ['count', 'checkers', 'readers', 'writers', 'track_items', 'compress', 'refresh_interval',
+                  'worker_name']
+    else:
+        if args.destination is None:
+            parser.error('the following arguments are required: destination')
+        unused = ['partitions', 'lease_timeout']
+        unused.append('count' if args.coordinator else 'worker_name')
+
+    for dest in unused:
+        if getattr(args, dest) != parser.get_default(dest):
+            parser.error(f"--{dest.replace('_', '-')} does not apply in this mode")
 
 
 def _configure_logging():
@@ -54,16 +122,22 @@ def move_data(
         num_checkers, num_readers, num_writers,
         log_queue,
         track_items, refresh_interval,
+        partition=None, display_factory=Display, compress=None,
 ):
     read_queue = Queue(maxsize=num_readers * 4)
     write_queue = Queue(maxsize=num_writers * 4)
     tracker_queue = Queue()
+    queues = [read_queue, write_queue, tracker_queue]
+    abort = Event()
 
     if num_checkers:
         check_queue = Queue(maxsize=num_checkers * 4)
+        queues.append(check_queue)
 
         checkers = [
-            RedisChecker(f'checker_{i}', destination, check_queue, read_queue, tracker_queue, log_queue, track_items)
+            RedisChecker(
+                f'checker_{i}', destination, check_queue, read_queue, tracker_queue, log_queue, track_items, abort,
+            )
             for i in range(num_checkers)
         ]
         for checker in checkers:
@@ -73,60 +147,111 @@ def move_data(
     else:
         scanner_destination = read_queue
 
-    scanner = RedisScanner(source, count, batch_size, scanner_destination, tracker_queue, log_queue, track_items)
+    scanner = RedisScanner(
+        source, count, batch_size, scanner_destination, tracker_queue, log_queue, track_items, partition, abort,
+    )
     scanner.start()
 
     readers = [
-        RedisReader(f'reader_{i}', source, read_queue, write_queue, tracker_queue, log_queue, track_items)
+        RedisReader(
+            f'reader_{i}', source, read_queue, write_queue, tracker_queue, log_queue, track_items, compress, abort,
+        )
         for i in range(num_readers)
     ]
     for reader in readers:
         reader.start()
 
     writers = [
-        RedisInserter(f'writer_{i}', destination, log_queue, write_queue, tracker_queue, track_items)
+        RedisInserter(f'writer_{i}', destination, log_queue, write_queue, tracker_queue, track_items, abort)
         for i in range(num_writers)
     ]
     for writer in writers:
         writer.start()
 
-    displayer = Display('display', tracker_queue, log_queue, refresh_interval)
+    displayer = display_factory('display', tracker_queue, log_queue, refresh_interval, abort)
     displayer.start()
 
     tracker = StatsTracker('global_0', tracker_queue)
 
+    stages = [scanner] + (checkers if num_checkers else []) + readers + writers
+
     with tracker.track('process'):
-        scanner.join()
+        _join_stages([scanner], stages, abort)
 
         if num_checkers:
             for _ in range(num_checkers):
-                check_queue.put(TombStone())
+                put_unless_aborted(check_queue, TombStone(), abort.is_set)
 
-            for checker in checkers:
-                checker.join()
+            _join_stages(checkers, stages, abort)
 
         for _ in range(num_readers):
-            read_queue.put(TombStone())
+            put_unless_aborted(read_queue, TombStone(), abort.is_set)
 
-        for reader in readers:
-            reader.join()
+        _join_stages(readers, stages, abort)
 
         for _ in range(num_writers):
-            write_queue.put(TombStone())
+            put_unless_aborted(write_queue, TombStone(), abort.is_set)
 
-        for writer in writers:
-            writer.join()
+        _join_stages(writers, stages, abort)
 
     displayer.stop()
 
+    if abort.is_set() or any(stage.exitcode != 0 for stage in stages):
+        for leftover_queue in queues:
+            leftover_queue.cancel_join_thread()
+        return False
+    return True
+
+
+def _join_stages(processes, stages, abort):
+    for process in processes:
+        while process.exitcode is None:
+            process.join(1.0)
+            if any(stage.exitcode for stage in stages):
+                # A crashed stage loses its batches and stops consuming, take the whole pipeline down
+                abort.set()
+
+
+def transfer_partitions(
+        coordinator, worker,
+        source, destination,
+        batch_size,
+        num_checkers, num_readers, num_writers,
+        log_queue,
+        track_items, refresh_interval,
+        compress=None,
+):
+    for partition_id, partition in claim_partitions(coordinator, worker):
+        reporter_factory = partial(
+            Reporter, coordinator=coordinator, worker=worker, partition_id=partition_id,
+        )
+        completed = move_data(
+            source, destination,
+            None, batch_size,
+            num_checkers, num_readers, num_writers,
+            log_queue,
+            track_items, refresh_interval,
+            partition=partition, display_factory=reporter_factory, compress=compress,
+        )
+        if completed:
+            complete_partition(coordinator, worker, partition_id)
+
 
 class RedisScanner(Source):
-    def __init__(self, source, count, batch_size, read_queue, results, log_queue, track_items):
+    def __init__(
+            self, source, count, batch_size, read_queue, results, log_queue, track_items, partition=None,
+            abort_event=None,
+    ):
         super(RedisScanner, self).__init__(
-            'scanner_0', results, log_queue, read_queue, count, batch_size, track_items,
+            'scanner_0', results, log_queue, read_queue, count, batch_size, track_items, abort_event,
         )
         redis = _redis_client(source, self.logger)
-        self.scan_iter = redis.scan_iter(count=batch_size)
+        if partition is None:
+            self.scan_iter = redis.scan_iter(count=batch_size)
+        elif isinstance(partition, str):
+            self.scan_iter = _scan_node(partition, batch_size)
+        else:
+            self.scan_iter = _scan_slots(redis, *partition, batch_size, self.logger)
 
     def produce_item(self):
         try:
@@ -136,9 +261,9 @@ class RedisScanner(Source):
 
 
 class RedisChecker(Processor):
-    def __init__(self, name, target_host, check_queue, read_queue, results, log_queue, track_items):
+    def __init__(self, name, target_host, check_queue, read_queue, results, log_queue, track_items, abort_event=None):
         super(RedisChecker, self).__init__(
-            name, results, log_queue, check_queue, read_queue, track_items,
+            name, results, log_queue, check_queue, read_queue, track_items, abort_event,
         )
         redis = _redis_client(target_host, self.logger)
         self.pipe = redis.pipeline()
@@ -153,12 +278,16 @@ class RedisChecker(Processor):
 
 
 class RedisReader(Processor):
-    def __init__(self, name, source, read_queue, write_queue, results, log_queue, track_items):
+    def __init__(
+            self, name, source, read_queue, write_queue, results, log_queue, track_items, compress=None,
+            abort_event=None,
+    ):
         super(RedisReader, self).__init__(
-            name, results, log_queue, read_queue, write_queue, track_items,
+            name, results, log_queue, read_queue, write_queue, track_items, abort_event,
         )
         redis = _redis_client(source, self.logger)
         self.pipe = redis.pipeline()
+        self.compress = compress
 
     def process_item(self, item):
         self.pipe.dump(item)
@@ -166,12 +295,14 @@ class RedisReader(Processor):
 
     def finalise_batch(self, batch):
         values = self.pipe.execute()
+        if self.compress:
+            return PackedBatch.pack(batch, values, CODECS[self.compress])
         return list(zip(batch, values))
 
 
 class RedisInserter(Drain):
-    def __init__(self, name, target_host, log_queue, input_queue, results, track_items):
-        super(RedisInserter, self).__init__(name, results, log_queue, input_queue, track_items)
+    def __init__(self, name, target_host, log_queue, input_queue, results, track_items, abort_event=None):
+        super(RedisInserter, self).__init__(name, results, log_queue, input_queue, track_items, abort_event)
 
         redis = _redis_client(target_host, self.logger)
         self.pipe = redis.pipeline()
@@ -183,4 +314,9 @@ class RedisInserter(Drain):
             return True
 
     def finalise_batch(self, _batch):
-        self.pipe.execute()
+        for result in self.pipe.execute(raise_on_error=False):
+            if isinstance(result, ResponseError) and str(result).startswith('BUSYKEY'):
+                # Copied already, by an earlier run or by the previous owner of a reassigned partition
+                self.tracker.increment('existing')
+            elif isinstance(result, Exception):
+                raise result
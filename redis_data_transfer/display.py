@@ -8,8 +8,8 @@ from redis_data_transfer.processing import BaseProcess
 
 
 class Display(BaseProcess):
-    def __init__(self, name, tracker_queue, log_queue, refresh_interval):
-        super(Display, self).__init__(name, tracker_queue, log_queue)
+    def __init__(self, name, tracker_queue, log_queue, refresh_interval, abort_event=None):
+        super(Display, self).__init__(name, tracker_queue, log_queue, abort_event)
         self.events_queue = tracker_queue
         self.interval = refresh_interval
         self._stop = Event()
@@ -0,0 +1,301 @@
+from argparse import ArgumentTypeError
+from datetime import timedelta
+from threading import Event, Lock, Thread
+import json
+import logging
+import socket
+import socketserver
+import time
+
+from rediscluster import RedisCluster
+
+from redis_data_transfer.display import Display
+from redis_data_transfer.redis_client import _redis_client
+
+
+CLUSTER_SLOTS = 16384
+LEASE_TIMEOUT_SEC = 30.0
+CLAIM_RETRY_SEC = 1.0
+CLAIM_RETRIES = 10
+FINISH_LINGER_SEC = 5.0
+REQUEST_TIMEOUT_SEC = 10
+
+logger = logging.getLogger(__name__)
+
+
+def run_coordinator(source, address, num_partitions, batch_size, lease_timeout):
+    client = _redis_client(source, logger)
+    if client is None:
+        logger.error("Cannot plan partitions without the source %s", source)
+        return False
+
+    coordinator = Coordinator(_plan_partitions(client, num_partitions, batch_size), lease_timeout)
+    logger.info("Serving %d partitions on %s", len(coordinator.partitions), address)
+
+    server = CoordinatorServer(_split_address(address), coordinator)
+    server_thread = Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    coordinator.finished.wait()
+    # Keep answering for a little while so idle workers learn that everything is done
+    time.sleep(FINISH_LINGER_SEC)
+    server.shutdown()
+    server.server_close()
+
+    for process, totals in sorted(coordinator.totals().items()):
+        logger.info(
+            '%s %s',
+            f'{process:<10}',
+            ''.join(f'{key} = {totals[key]}  ' for key in sorted(totals.keys())),
+        )
+    return True
+
+
+def claim_partitions(coordinator, worker):
+    attempts = 0
+    while True:
+        try:
+            response = _request(coordinator, {'op': 'claim', 'worker': worker})
+        except OSError:
+            attempts += 1
+            if attempts >= CLAIM_RETRIES:
+                logger.warning("Coordinator %s unreachable, stopping", coordinator)
+                return
+            time.sleep(CLAIM_RETRY_SEC)
+            continue
+        attempts = 0
+
+        if response.get('done'):
+            return
+        if response.get('wait'):
+            time.sleep(CLAIM_RETRY_SEC)
+            continue
+
+        partition = response['partition']
+        yield response['id'], tuple(partition) if isinstance(partition, list) else partition
+
+
+def complete_partition(coordinator, worker, partition_id):
+    try:
+        _request(coordinator, {'op': 'complete', 'worker': worker, 'id': partition_id})
+    except OSError:
+        logger.warning("Could not report completion of partition %d to %s", partition_id, coordinator)
+
+
+def partition_count(value):
+    num_partitions = int(value)
+    if not 1 <= num_partitions <= CLUSTER_SLOTS:
+        raise ArgumentTypeError(f'must be between 1 and {CLUSTER_SLOTS}')
+    return num_partitions
+
+
+def _plan_partitions(client, num_partitions, batch_size):
+    """
+    Split the source keyspace so that every key belongs to exactly one partition.
+
+    A partition is None for a whole single server, a (first_slot, last_slot) range read slot by
+    slot, or the "host:port" of a cluster master to SCAN as a whole.
+    """
+    if not isinstance(client, RedisCluster):
+        # A single server has no slots to split on, it is scanned as a whole
+        return [None]
+
+    masters = {}
+    for slot_range, nodes in client.cluster_slots().items():
+        host, port = nodes['master'][:2]
+        masters.setdefault(f'{host}:{port}', []).append(slot_range)
+
+    node_partitions = []
+    slot_ranges = []
+    for master, master_ranges in sorted(masters.items()):
+        if _has_crowded_slot(client, master_ranges, batch_size):
+            # GETKEYSINSLOT cannot be paged, so a master with a slot larger than a batch is SCANned once
+            node_partitions.append(master)
+        else:
+            slot_ranges.extend(master_ranges)
+
+    return node_partitions + _split_slot_ranges(slot_ranges, max(num_partitions - len(node_partitions), 1))
+
+
+def _has_crowded_slot(client, slot_ranges, batch_size):
+    return any(
+        client.cluster_countkeysinslot(slot) > batch_size
+        for first_slot, last_slot in slot_ranges
+        for slot in range(first_slot, last_slot + 1)
+    )
+
+
+def _split_slot_ranges(slot_ranges, num_partitions):
+    merged = []
+    for first_slot, last_slot in sorted(slot_ranges):
+        if merged and merged[-1][1] + 1 == first_slot:
+            merged[-1] = (merged[-1][0], last_slot)
+        else:
+            merged.append((first_slot, last_slot))
+
+    num_slots = sum(last_slot - first_slot + 1 for first_slot, last_slot in merged)
+    step = max(-(-num_slots // num_partitions), 1)
+    return [
+        (start, min(start + step - 1, last_slot))
+        for first_slot, last_slot in merged
+        for start in range(first_slot, last_slot + 1, step)
+    ]
+
+
+def _split_address(address):
+    host, port = address.rsplit(':', maxsplit=1)
+    return host, int(port)
+
+
+def _request(address, message):
+    with socket.create_connection(_split_address(address), timeout=REQUEST_TIMEOUT_SEC) as sock:
+        stream = sock.makefile('rwb')
+        stream.write(json.dumps(message).encode() + b'\n')
+        stream.flush()
+        reply = stream.readline()
+
+    try:
+        return json.loads(reply)
+    except ValueError:
+        # An empty or truncated reply means the coordinator dropped the request
+        raise ConnectionError(f"Invalid reply from coordinator {address}: {reply!r}")
+
+
+class Coordinator:
+    def __init__(self, partitions, lease_timeout=LEASE_TIMEOUT_SEC):
+        self.partitions = list(partitions)
+        self.lease_timeout = lease_timeout
+        self.pending = list(range(len(self.partitions)))
+        self.leases = {}
+        self.completed = {}
+        self.stats = {}
+        self.finished = Event()
+        self._lock = Lock()
+        if not self.partitions:
+            self.finished.set()
+
+    def handle(self, message):
+        with self._lock:
+            op = message.get('op')
+            if op == 'claim':
+                return self.claim(message['worker'])
+            if op == 'report':
+                return self.report(message['worker'], message['id'], message['stats'])
+            if op == 'complete':
+                return self.complete(message['worker'], message['id'])
+            return {'error': f'unknown op {op!r}'}
+
+    def claim(self, worker):
+        self._expire_leases()
+
+        if self.pending:
+            partition_id = self.pending.pop(0)
+            self.leases[partition_id] = (worker, time.monotonic() + self.lease_timeout)
+            logger.info("Partition %d claimed by %s", partition_id, worker)
+            return {'id': partition_id, 'partition': self.partitions[partition_id]}
+
+        if self.leases:
+            return {'wait': True}
+
+        return {'done': True}
+
+    def report(self, worker, partition_id, stats):
+        holder, _deadline = self.leases.get(partition_id, (None, None))
+        if holder != worker:
+            return {'ok': False}
+
+        # Stats are cumulative per run, a reassigned partition only counts its current owner
+        self.stats[partition_id] = stats
+        self.leases[partition_id] = (worker, time.monotonic() + self.lease_timeout)
+        return {'ok': True}
+
+    def complete(self, worker, partition_id):
+        if partition_id not in self.completed:
+            self.completed[partition_id] = worker
+            self.leases.pop(partition_id, None)
+            if partition_id in self.pending:
+                self.pending.remove(partition_id)
+            logger.info(
+                "Partition %d completed by %s (%d/%d)",
+                partition_id, worker, len(self.completed), len(self.partitions),
+            )
+
+        if len(self.completed) == len(self.partitions):
+            self.finished.set()
+        return {'ok': True}
+
+    def totals(self):
+        totals = {}
+        for stats in self.stats.values():
+            for process, values in stats.items():
+                process_totals = totals.setdefault(process, {})
+                for reference, value in values.items():
+                    process_totals[reference] = process_totals.get(reference, 0) + value
+        return totals
+
+    def _expire_leases(self):
+        now = time.monotonic()
+        for partition_id, (worker, deadline) in list(self.leases.items()):
+            if deadline <= now:
+                logger.warning("Lease of %s on partition %d expired, reassigning", worker, partition_id)
+                del self.leases[partition_id]
+                self.pending.append(partition_id)
+
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, coordinator):
+        super(CoordinatorServer, self).__init__(server_address, _CoordinatorHandler)
+        self.coordinator = coordinator
+
+
+class _CoordinatorHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        message = json.loads(self.rfile.readline())
+        response = self.server.coordinator.handle(message)
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class Reporter(Display):
+    def __init__(
+            self, name, tracker_queue, log_queue, refresh_interval, abort_event,
+            coordinator, worker, partition_id,
+    ):
+        super(Reporter, self).__init__(name, tracker_queue, log_queue, refresh_interval, abort_event)
+        self.coordinator = coordinator
+        self.worker = worker
+        self.partition_id = partition_id
+
+    def execute(self):
+        while not (self._stop.is_set() and self.events_queue.empty()):
+            if self.is_aborted():
+                # Stop renewing the lease so the partition gets reassigned
+                return
+            self._render_result()
+            self._process_events()
+        self._render_result()
+
+    def _render_result(self):
+        stats = {
+            process: {
+                reference: value.total_seconds() if isinstance(value, timedelta) else value
+                for reference, value in values.items()
+            }
+            for process, values in self.state.items()
+        }
+        try:
+            response = _request(self.coordinator, {
+                'op': 'report',
+                'worker': self.worker,
+                'id': self.partition_id,
+                'stats': stats,
+            })
+        except OSError:
+            self.warning("Could not report to coordinator %s", self.coordinator)
+            return
+
+        if not response.get('ok'):
+            self.warning("Partition %d was reassigned, stopping", self.partition_id)
+            self.abort.set()
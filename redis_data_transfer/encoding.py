@@ -0,0 +1,119 @@
+from array import array
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+COMPRESS_MIN_BYTES = 1024
+ZLIB_LEVEL = 1
+
+RAW = 0
+ZLIB = 1
+LZ4 = 2
+MISSING = 255
+
+CODECS = {'zlib': ZLIB}
+if lz4 is not None:
+    CODECS['lz4'] = LZ4
+
+
+def _compress(value, codec):
+    if len(value) < COMPRESS_MIN_BYTES:
+        return RAW, value
+
+    if codec == LZ4:
+        compressed = lz4.frame.compress(value)
+    else:
+        compressed = zlib.compress(value, ZLIB_LEVEL)
+
+    if len(compressed) >= len(value):
+        return RAW, value
+    return codec, compressed
+
+
+def _decompress(codec, payload):
+    if codec == RAW:
+        return payload
+    if codec == ZLIB:
+        return zlib.decompress(payload)
+    if codec == LZ4:
+        if lz4 is None:
+            raise RuntimeError("Batch was compressed with lz4, which is not installed")
+        return lz4.frame.decompress(payload)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def _compact_lengths(lengths):
+    # Store lengths with the smallest item size that fits, keys and small values need a single byte
+    for typecode in ('B', 'H', 'I', 'Q'):
+        compact = array(typecode)
+        if max(lengths, default=0) < 1 << (8 * compact.itemsize):
+            compact.extend(lengths)
+            return compact
+
+
+class PackedBatch:
+    """
+    Key/value pairs of a batch packed into two contiguous buffers with lengths arrays.
+
+    Each value is compressed on its own when it is large enough, so iterating yields the same
+    (key, value) tuples as the plain list batches.
+    """
+
+    def __init__(self, keys, key_lengths, values, value_lengths, codecs):
+        self.keys = keys
+        self.key_lengths = key_lengths
+        self.values = values
+        self.value_lengths = value_lengths
+        self.codecs = codecs
+
+    @classmethod
+    def pack(cls, keys, values, codec=ZLIB):
+        key_lengths = []
+        value_lengths = []
+        codecs = bytearray()
+        key_buffer = bytearray()
+        value_buffer = bytearray()
+
+        for key, value in zip(keys, values):
+            if isinstance(key, str):
+                key = key.encode()
+            key_buffer += key
+            key_lengths.append(len(key))
+
+            if value is None:
+                value_codec, payload = MISSING, b''
+            else:
+                value_codec, payload = _compress(value, codec)
+            codecs.append(value_codec)
+            value_buffer += payload
+            value_lengths.append(len(payload))
+
+        return cls(
+            key_buffer, _compact_lengths(key_lengths), value_buffer, _compact_lengths(value_lengths), codecs,
+        )
+
+    def __reduce__(self):
+        return self.__class__, (self.keys, self.key_lengths, self.values, self.value_lengths, self.codecs)
+
+    def __len__(self):
+        return len(self.codecs)
+
+    def __iter__(self):
+        keys = memoryview(self.keys)
+        values = memoryview(self.values)
+        key_start = value_start = 0
+
+        for key_length, value_length, codec in zip(self.key_lengths, self.value_lengths, self.codecs):
+            key = bytes(keys[key_start:key_start + key_length])
+            key_start += key_length
+
+            if codec == MISSING:
+                yield key, None
+            else:
+                payload = bytes(values[value_start:value_start + value_length])
+                yield key, _decompress(codec, payload)
+            value_start += value_length
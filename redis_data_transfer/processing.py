@@ -1,7 +1,8 @@
 import logging
 from logging.handlers import QueueHandler
-from multiprocessing import Process
-from queue import Empty
+from multiprocessing import Event, Process
+import os
+from queue import Empty, Full
 
 import setproctitle
 
@@ -12,6 +13,16 @@ class TombStone:
     pass
 
 
+def put_unless_aborted(target_queue, item, is_aborted):
+    while not is_aborted():
+        try:
+            target_queue.put(item, True, 1.0)
+            return True
+        except Full:
+            continue
+    return False
+
+
 class QueueLoggingMixin:
     def __init__(self, log_queue):
         log_handler = QueueHandler(log_queue)
@@ -35,31 +46,47 @@ class QueueLoggingMixin:
 
 
 class BaseProcess(Process, QueueLoggingMixin):
-    def __init__(self, name, tracker_queue, log_queue):
+    def __init__(self, name, tracker_queue, log_queue, abort_event=None):
         super(BaseProcess, self).__init__(name=name)
         QueueLoggingMixin.__init__(self, log_queue)
         self.tracker = StatsTracker(name, tracker_queue)
+        self.abort = abort_event if abort_event is not None else Event()
+        self.outputs = [tracker_queue]
 
     def run(self):
         setproctitle.setproctitle(self.name)
+        self.parent_pid = os.getppid()
         self.execute()
+        if self.abort.is_set():
+            # Nobody may be left to read our queues, do not wait for them to be flushed on exit
+            for output in self.outputs:
+                output.cancel_join_thread()
 
     def execute(self):
         raise NotImplementedError
 
+    def is_aborted(self):
+        if not self.abort.is_set() and os.getppid() != self.parent_pid:
+            # The process driving the pipeline is gone, nobody will send a TombStone or read our results
+            self.warning("Parent of %s died, stopping", self.name)
+            self.abort.set()
+        return self.abort.is_set()
+
 
 class Source(BaseProcess):
     def __init__(
             self, name, tracker_queue, log_queue, target_queue, count, batch_size, track_items=True,
+            abort_event=None,
     ):
-        super(Source, self).__init__(name, tracker_queue, log_queue)
+        super(Source, self).__init__(name, tracker_queue, log_queue, abort_event)
         self.output = target_queue
+        self.outputs.append(target_queue)
         self.batch_size = batch_size
         self.count = count
         self.track_items = track_items
 
     def execute(self):
-        while True:
+        while not self.is_aborted():
             with self.tracker.track('process'):
                 batch = self.produce_batch()
             if batch is None:
@@ -95,18 +122,18 @@ class Source(BaseProcess):
 
     def emit_batch(self, batch):
         with self.tracker.track('wait'):
-            self.output.put(batch)
+            put_unless_aborted(self.output, batch, self.is_aborted)
         self.tracker.increment('batches')
 
 
 class Drain(BaseProcess):
-    def __init__(self, name, tracker_queue, log_queue, input_queue, track_items=True):
-        super(Drain, self).__init__(name, tracker_queue, log_queue)
+    def __init__(self, name, tracker_queue, log_queue, input_queue, track_items=True, abort_event=None):
+        super(Drain, self).__init__(name, tracker_queue, log_queue, abort_event)
         self.input = input_queue
         self.track_items = track_items
 
     def execute(self):
-        while True:
+        while not self.is_aborted():
             try:
                 with self.tracker.track('wait'):
                     batch = self.input.get(True, 1.0)
@@ -138,13 +165,17 @@ class Drain(BaseProcess):
 
 
 class Processor(Drain):
-    def __init__(self, name, tracker_queue, log_queue, input_queue, output_queue, track_items=True):
-        super(Processor, self).__init__(name, tracker_queue, log_queue, input_queue, track_items)
+    def __init__(
+            self, name, tracker_queue, log_queue, input_queue, output_queue, track_items=True,
+            abort_event=None,
+    ):
+        super(Processor, self).__init__(name, tracker_queue, log_queue, input_queue, track_items, abort_event)
         self.output = output_queue
+        self.outputs.append(output_queue)
 
     def process_results(self, results):
         with self.tracker.track('wait'):
-            self.output.put(results)
+            put_unless_aborted(self.output, results, self.is_aborted)
 
     def process_item(self, item) -> bool:
         raise NotImplementedError
@@ -32,7 +32,7 @@ def _redis_client(host, logger):
     except ConnectionError:
         pass
 
-    logger.error("Could not connect to cluster/host", host)
+    logger.error("Could not connect to cluster/host %s", host)
     return None
 
 
@@ -50,3 +50,20 @@ def _split_host(host):
         port = "6379"
 
     return {'host': hostname, 'port': port, 'db': int(database)}
+
+
+def _scan_slots(client, first_slot, last_slot, batch_size, logger):
+    for slot in range(first_slot, last_slot + 1):
+        num_keys = client.cluster_countkeysinslot(slot)
+        if num_keys > batch_size:
+            logger.warning("Slot %d grew to %d keys since partitions were planned", slot, num_keys)
+        if num_keys:
+            yield from client.cluster_get_keys_in_slot(slot, num_keys)
+
+
+def _scan_node(node, batch_size):
+    client = Redis(
+        **_split_host(node),
+        socket_connect_timeout=CONNECT_TIMEOUT_SEC,
+    )
+    yield from client.scan_iter(count=batch_size)
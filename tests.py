@@ -1,12 +1,31 @@
+from argparse import ArgumentTypeError
+from multiprocessing import Process
+from threading import Thread
 import contextlib
+import logging
 import os
+import pickle
 import queue
+import signal
+import socket
+import time
 import unittest
 
+from rediscluster import RedisCluster
 import docker
 import redis
 
-from redis_data_transfer import move_data
+from redis_data_transfer import move_data, transfer_partitions
+from redis_data_transfer.distributed import (
+    CLUSTER_SLOTS,
+    Coordinator,
+    CoordinatorServer,
+    _plan_partitions,
+    _split_slot_ranges,
+    partition_count,
+)
+from redis_data_transfer.encoding import CODECS, LZ4, MISSING, RAW, PackedBatch
+from redis_data_transfer.redis_client import _redis_client
 
 
 REDIS_DOCKER_IMAGE = "redis:5-alpine"
@@ -37,6 +56,58 @@ def redis_server(container_name):
         client.close()
 
 
+@contextlib.contextmanager
+def redis_cluster_server(container_name):
+    """A single node cluster owning every slot, on the host network so it announces a reachable address."""
+    full_container_name = "redis_data_transfer_test_redis_cluster_{}_{}".format(container_name, os.getpid())
+    client = docker.from_env()
+
+    port = _free_port()
+    container = None
+    try:
+        container = client.containers.run(
+            REDIS_DOCKER_IMAGE,
+            command=[
+                "redis-server", "--port", str(port),
+                "--cluster-enabled", "yes", "--cluster-announce-ip", "127.0.0.1",
+            ],
+            remove=True,
+            detach=True,
+            network_mode="host",
+            name=full_container_name,
+        )
+        node = redis.Redis(host="127.0.0.1", port=port)
+        _wait_until(lambda: _is_up(node))
+        node.cluster("addslots", *range(CLUSTER_SLOTS))
+        _wait_until(lambda: node.cluster("info")["cluster_state"] == "ok")
+        yield port
+    finally:
+        if container is not None:
+            container.remove(force=True)
+        client.close()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _is_up(client):
+    try:
+        return client.ping()
+    except redis.ConnectionError:
+        return False
+
+
+def _wait_until(predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for redis")
+        time.sleep(0.1)
+
+
 class TestRedisDataTransfer(unittest.TestCase):
     def test_copy_simple(self):
         with redis_server("source") as source_port, redis_server("destination") as destination_port:
@@ -83,6 +154,16 @@ class TestRedisDataTransfer(unittest.TestCase):
                 sample_size=10000,
             )
 
+    def test_copy_compressed(self):
+        with redis_server("source") as source_port, redis_server("destination") as destination_port:
+            _check_move_data(
+                source_port, destination_port,
+                count=None, batch_size=1000,
+                num_checkers=1, num_readers=1, num_writers=1,
+                sample_size=1000,
+                compress='zlib',
+            )
+
     def test_copy_with_checker_and_preexisting_data(self):
         with redis_server("source") as source_port, redis_server("destination") as destination_port:
             batch_size = 100
@@ -134,12 +215,334 @@ class TestRedisDataTransfer(unittest.TestCase):
             assert num_inserted_source == source.dbsize()
             assert num_inserted_source == destination.dbsize()
 
+    def test_copy_cluster_partitions_once(self):
+        with redis_cluster_server("source") as source_port, redis_server("destination") as destination_port:
+            source = redis.Redis(host="127.0.0.1", port=source_port)
+            destination = redis.Redis(host="127.0.0.1", port=destination_port)
+
+            num_inserted = _insert_fake_data(source, 1000)
+
+            partitions = _plan_partitions(_source_client(source_port), 7, batch_size=1000)
+            assert 7 == len(partitions)
+            assert all(isinstance(partition, tuple) for partition in partitions)
+
+            coordinator = Coordinator(partitions)
+            _run_workers(coordinator, ("worker_a", "worker_b"), source_port, destination_port, batch_size=1000)
+
+            assert num_inserted == destination.dbsize()
+            # Disjoint partitions never restore a key twice
+            assert not any('existing' in values for values in coordinator.totals().values())
+
+    def test_copy_crowded_cluster_by_node(self):
+        with redis_cluster_server("source") as source_port, redis_server("destination") as destination_port:
+            source = redis.Redis(host="127.0.0.1", port=source_port)
+            destination = redis.Redis(host="127.0.0.1", port=destination_port)
+
+            num_inserted = _insert_fake_data(source, 1000)
+
+            # With batches of 1 key, any slot holding two keys is too large to fetch at once
+            partitions = _plan_partitions(_source_client(source_port), 7, batch_size=1)
+            assert [f"127.0.0.1:{source_port}"] == partitions
+
+            coordinator = Coordinator(partitions)
+            _run_workers(coordinator, ("worker_a", "worker_b"), source_port, destination_port, batch_size=1)
+
+            assert num_inserted == destination.dbsize()
+            assert not any('existing' in values for values in coordinator.totals().values())
+
+    def test_copy_distributed_with_killed_worker(self):
+        with redis_cluster_server("source") as source_port, redis_server("destination") as destination_port:
+            source = redis.Redis(host="127.0.0.1", port=source_port)
+            destination = redis.Redis(host="127.0.0.1", port=destination_port)
+
+            num_inserted = _insert_fake_data(source, 20000)
+
+            coordinator = Coordinator(
+                _plan_partitions(_source_client(source_port), 4, batch_size=100), lease_timeout=3,
+            )
+            killed_partition = _run_workers(
+                coordinator, ("worker_a", "worker_b"), source_port, destination_port, batch_size=100,
+                killed_worker="worker_a",
+            )
+
+            assert "worker_b" == coordinator.completed[killed_partition]
+            assert num_inserted == destination.dbsize()
+
+    def test_copy_fails_when_a_writer_crashes(self):
+        with redis_server("source") as source_port, redis_server("destination") as destination_port:
+            source = redis.Redis(host="127.0.0.1", port=source_port)
+            destination = redis.Redis(host="127.0.0.1", port=destination_port)
+
+            _insert_fake_data(source, 1000)
+            # Every RESTORE is refused with an OOM error
+            destination.config_set("maxmemory", 1)
+
+            completed = move_data(
+                source=f'127.0.0.1:{source_port}',
+                destination=f'127.0.0.1:{destination_port}',
+                count=None,
+                batch_size=100,
+                num_checkers=0,
+                num_readers=1,
+                num_writers=2,
+                log_queue=queue.Queue(),
+                track_items=False,
+                refresh_interval=1.0,
+            )
+
+            assert not completed
+
+    def test_copy_reassigned_partition(self):
+        with redis_server("source") as source_port, redis_server("destination") as destination_port:
+            source = redis.Redis(host="127.0.0.1", port=source_port)
+            destination = redis.Redis(host="127.0.0.1", port=destination_port)
+
+            num_inserted = _insert_fake_data(source, 1000)
+
+            coordinator = Coordinator([None], lease_timeout=1)
+            # A worker that claims the partition, copies part of it and dies without reporting
+            coordinator.claim("worker_a")
+            move_data(
+                source=f'127.0.0.1:{source_port}',
+                destination=f'127.0.0.1:{destination_port}',
+                count=100,
+                batch_size=100,
+                num_checkers=0,
+                num_readers=1,
+                num_writers=1,
+                log_queue=queue.Queue(),
+                track_items=False,
+                refresh_interval=1.0,
+            )
+            assert 100 == destination.dbsize()
+
+            server = CoordinatorServer(("127.0.0.1", 0), coordinator)
+            server_thread = Thread(target=server.serve_forever, daemon=True)
+            server_thread.start()
+            coordinator_address = "127.0.0.1:{}".format(server.server_address[1])
+
+            try:
+                transfer_partitions(
+                    coordinator_address, "worker_b",
+                    source=f'127.0.0.1:{source_port}',
+                    destination=f'127.0.0.1:{destination_port}',
+                    batch_size=100,
+                    num_checkers=0,
+                    num_readers=1,
+                    num_writers=1,
+                    log_queue=queue.Queue(),
+                    track_items=False,
+                    refresh_interval=1.0,
+                )
+            finally:
+                server.shutdown()
+                server.server_close()
+
+            assert coordinator.finished.is_set()
+            assert num_inserted == destination.dbsize()
+
+
+class TestPlanPartitions(unittest.TestCase):
+    def test_slot_ranges_cover_every_slot_once(self):
+        for num_partitions in (1, 3, 7, 64, CLUSTER_SLOTS):
+            partitions = _split_slot_ranges([(0, CLUSTER_SLOTS - 1)], num_partitions)
+
+            assert len(partitions) <= num_partitions
+            assert list(range(CLUSTER_SLOTS)) == _slots_of(partitions)
+
+    def test_fragmented_slot_ranges_are_merged(self):
+        partitions = _split_slot_ranges([(100, 199), (0, 99), (300, 399)], 3)
+
+        assert list(range(200)) + list(range(300, 400)) == _slots_of(partitions)
+
+    def test_single_server_is_one_partition(self):
+        assert [None] == _plan_partitions(object(), 7, 100)
+
+    def test_crowded_master_is_scanned_as_a_node(self):
+        client = _StubCluster(
+            {(0, 8191): ("10.0.0.1", 7000), (8192, CLUSTER_SLOTS - 1): ("10.0.0.2", 7000)},
+            crowded_slot=9000,
+        )
+
+        partitions = _plan_partitions(client, 7, batch_size=100)
+
+        assert "10.0.0.2:7000" == partitions[0]
+        assert list(range(8192)) == _slots_of(partitions[1:])
+        assert 7 == len(partitions)
+
+
+class _StubCluster(RedisCluster):
+    """Answers the cluster calls made when planning partitions, without a server."""
+
+    def __init__(self, masters, crowded_slot):
+        self.connection = None
+        self.masters = masters
+        self.crowded_slot = crowded_slot
+
+    def cluster_slots(self):
+        return {slot_range: {'master': master, 'slaves': []} for slot_range, master in self.masters.items()}
+
+    def cluster_countkeysinslot(self, slot):
+        return 1000 if slot == self.crowded_slot else 1
+
+
+def _slots_of(partitions):
+    return [slot for first_slot, last_slot in partitions for slot in range(first_slot, last_slot + 1)]
+
+
+class TestPackedBatch(unittest.TestCase):
+    def test_round_trip(self):
+        keys = [b"small", "text", b"large", b"missing", b""]
+        values = [b"value", b"", b"x" * 10000, None, b"y"]
+
+        batch = PackedBatch.pack(keys, values)
+
+        assert len(keys) == len(batch)
+        assert [
+            (b"small", b"value"), (b"text", b""), (b"large", b"x" * 10000), (b"missing", None), (b"", b"y"),
+        ] == list(batch)
+        assert len(batch.values) < 10000
+
+    @unittest.skipUnless('lz4' in CODECS, "lz4 is not installed")
+    def test_round_trip_lz4(self):
+        keys = [b"small", b"large", b"missing"]
+        values = [b"value", b"x" * 10000, None]
+
+        batch = PackedBatch.pack(keys, values, CODECS['lz4'])
+
+        assert bytes([RAW, LZ4, MISSING]) == bytes(batch.codecs)
+        assert list(zip(keys, values)) == list(pickle.loads(pickle.dumps(batch)))
+
+    def test_smaller_than_tuples_when_pickled(self):
+        for num_items, value_size in ((100, 3), (10000, 50)):
+            keys = [f"key_{i:016}".encode() for i in range(num_items)]
+            values = [b"v" * value_size for _ in range(num_items)]
+
+            packed_size = len(pickle.dumps(PackedBatch.pack(keys, values)))
+            assert packed_size < len(pickle.dumps(list(zip(keys, values))))
+
+
+class TestCoordinator(unittest.TestCase):
+    def test_partitions_handed_out_once(self):
+        coordinator = Coordinator([(0, 99), (100, 199)])
+
+        assert {'id': 0, 'partition': (0, 99)} == coordinator.claim("worker_a")
+        assert {'id': 1, 'partition': (100, 199)} == coordinator.claim("worker_b")
+        assert {'wait': True} == coordinator.claim("worker_c")
+
+        coordinator.complete("worker_a", 0)
+        coordinator.complete("worker_b", 1)
+
+        assert coordinator.finished.is_set()
+        assert {'done': True} == coordinator.claim("worker_c")
+
+    def test_expired_lease_is_reassigned(self):
+        coordinator = Coordinator([(0, 16383)], lease_timeout=0)
+
+        assert 0 == coordinator.claim("worker_a")['id']
+        assert 0 == coordinator.claim("worker_b")['id']
+        assert {'ok': False} == coordinator.report("worker_a", 0, {})
+
+        coordinator.complete("worker_b", 0)
+        assert coordinator.finished.is_set()
+
+    def test_totals_sum_reports(self):
+        coordinator = Coordinator([None, None])
+        coordinator.claim("worker_a")
+        coordinator.claim("worker_b")
+        coordinator.report("worker_a", 0, {'writer_0': {'batches': 2, 'process': 1.5}})
+        coordinator.report("worker_b", 1, {'writer_0': {'batches': 3, 'process': 0.5}})
+
+        assert {'writer_0': {'batches': 5, 'process': 2.0}} == coordinator.totals()
+
+    def test_totals_ignore_previous_owner(self):
+        coordinator = Coordinator([None], lease_timeout=0)
+        coordinator.claim("worker_a")
+        coordinator.report("worker_a", 0, {'writer_0': {'batches': 2}})
+        coordinator.claim("worker_b")
+        coordinator.report("worker_b", 0, {'writer_0': {'batches': 3}})
+        coordinator.report("worker_a", 0, {'writer_0': {'batches': 4}})
+
+        assert {'writer_0': {'batches': 3}} == coordinator.totals()
+
+    def test_partition_count_is_validated(self):
+        assert 1 == partition_count("1")
+        assert 16384 == partition_count("16384")
+        with self.assertRaises(ArgumentTypeError):
+            partition_count("0")
+        with self.assertRaises(ArgumentTypeError):
+            partition_count("16385")
+
+
+def _source_client(port):
+    return _redis_client(f"127.0.0.1:{port}", logging.getLogger(__name__))
+
+
+def _run_workers(coordinator, worker_names, source_port, destination_port, batch_size, killed_worker=None):
+    server = CoordinatorServer(("127.0.0.1", 0), coordinator)
+    server_thread = Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    coordinator_address = "127.0.0.1:{}".format(server.server_address[1])
+
+    workers = {
+        worker: Process(
+            target=transfer_partitions,
+            args=(coordinator_address, worker),
+            kwargs=dict(
+                source=f'127.0.0.1:{source_port}',
+                destination=f'127.0.0.1:{destination_port}',
+                batch_size=batch_size,
+                num_checkers=0,
+                num_readers=2,
+                num_writers=2,
+                log_queue=queue.Queue(),
+                track_items=False,
+                refresh_interval=0.5,
+            ),
+        )
+        for worker in worker_names
+    }
+
+    killed_partition = None
+    try:
+        for process in workers.values():
+            process.start()
+
+        if killed_worker is not None:
+            killed_partition = _wait_for_lease(coordinator, killed_worker)
+            os.kill(workers[killed_worker].pid, signal.SIGKILL)
+
+        assert coordinator.finished.wait(120)
+        for worker, process in workers.items():
+            if worker != killed_worker:
+                process.join(30)
+                assert 0 == process.exitcode
+    finally:
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+        server.shutdown()
+        server.server_close()
+
+    return killed_partition
+
+
+def _wait_for_lease(coordinator, worker, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for partition_id, (holder, _deadline) in list(coordinator.leases.items()):
+            if holder == worker:
+                return partition_id
+        time.sleep(0.05)
+    raise AssertionError(f"{worker} never claimed a partition")
+
 
 def _check_move_data(
         source_port, destination_port,
         count, batch_size,
         num_checkers, num_readers, num_writers,
         sample_size,
+        compress=None,
 ):
     source = redis.Redis(host="127.0.0.1", port=source_port)
     destination = redis.Redis(host="127.0.0.1", port=destination_port)
@@ -164,6 +567,7 @@ def _check_move_data(
         log_queue=dummy_log_queue,
         track_items=False,
         refresh_interval=1.0,
+        compress=compress,
     )
 
     assert num_inserted == source.dbsize()
@@ -177,7 +581,8 @@ def _check_move_data(
 
 
 def _insert_fake_data(client, sample_size):
-    pipe = client.pipeline()
+    # No transaction, a cluster node refuses MULTI blocks that span several slots
+    pipe = client.pipeline(transaction=False)
     keys_created = 0
 
     for key, value in [(f"key_{i}", f"value_{i}") for i in range(sample_size)]: